@@ -2,12 +2,42 @@ from dotenv import load_dotenv
 
 load_dotenv(override=True)
 
+import os
+from contextlib import asynccontextmanager
+
+import httpx
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from routers import docint, upload
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Induláskor előmelegítjük a klienseket, így az első kérés nem fizeti meg
+    # a connection string parse + TCP/TLS handshake költségét.
+    if os.getenv("AZURE_STORAGE_CONNECTION_STRING"):
+        docint.get_result_container()
+        upload.get_blob_service_client()
+
+    # Egyetlen, kérések között újrahasznált httpx kliens a DI hívásokhoz.
+    # HTTP/2 + keep-alive: a TLS session-öket újrahasznosítjuk, a kérések
+    # pedig multiplexálódnak ugyanazon a kapcsolaton.
+    app.state.di_client = httpx.AsyncClient(
+        http2=True,
+        timeout=60,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50),
+    )
+
+    yield
+
+    # Leálláskor rendesen lezárjuk a cache-elt klienseket.
+    await app.state.di_client.aclose()
+    await docint.close_blob_client()
+    await upload.close_blob_client()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost",
@@ -1,44 +1,197 @@
-import base64
 import re
+import secrets
+import time
 import unicodedata
-from datetime import datetime
+from io import BytesIO
+from urllib.parse import unquote
 import os
 from fastapi import APIRouter, HTTPException, Request, status
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from fastapi.responses import ORJSONResponse
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient
 
-router = APIRouter(prefix="/upload", tags=["upload"])
+# SIMD-gyorsított (AVX2/SSSE3/NEON) base64 decoder — többszörös gyorsulás a
+# stdlib-hez képest a több MB-os PDF payloadokon, drop-in API-val.
+import pybase64
+
+# orjson: a több MB-os base64 mezőt tartalmazó JSON body-t is lényegesen
+# gyorsabban parse-olja a stdlib-nél, és bytes-ból dolgozik str kitérő nélkül.
+import orjson
+
+# ORJSONResponse: a válasz serializálása is orjson-nal fut, nem a stdlib
+# json.dumps Python szintű vezérlésével.
+router = APIRouter(
+    prefix="/upload", tags=["upload"], default_response_class=ORJSONResponse
+)
 
 CONTAINER_NAME = "invoicebatch"
 
+# Egy menetes slug minta, modul szinten fordítva (nem kérésenként): minden nem
+# engedélyezett karakter-futamot egyetlen _-re cserélünk. Az aláhúzás szándékosan
+# nincs az engedélyezett osztályban, így a "__" futamok is összeesnek — nem kell
+# külön "_+" összevonó kör. Bytes minta: az sre byte módban nem viszi a
+# Unicode kódpont-gépezetet, így gyorsabb.
+_SLUG_RE = re.compile(rb"[^A-Za-z0-9.-]+")
+
+# Magyar + gyakori latin ékezetes betűk közvetlen ASCII megfelelői: a
+# str.translate egyetlen C szintű menet, szemben az NFKD normalizálás +
+# encode/decode hármassal (három végigjárás, két köztes allokáció). A ritka,
+# táblán kívüli kódpontokra marad az NFKD fallback.
+_FOLD = str.maketrans(
+    {
+        "á": "a", "é": "e", "í": "i", "ó": "o", "ö": "o", "ő": "o",
+        "ú": "u", "ü": "u", "ű": "u",
+        "Á": "A", "É": "E", "Í": "I", "Ó": "O", "Ö": "O", "Ő": "O",
+        "Ú": "U", "Ü": "U", "Ű": "U",
+        "à": "a", "â": "a", "ä": "a", "ç": "c", "è": "e", "ê": "e",
+        "ë": "e", "î": "i", "ï": "i", "ô": "o", "ù": "u", "û": "u",
+    }
+)
+
+# Méretlimit: ennél nagyobb PDF-et el sem kezdünk dekódolni — a hibás/túl nagy
+# kérés így közel nulla CPU-val kap 413-at. A base64 4/3-szorosára fújja a
+# méretet, ezért a limitet a kódolt hosszra számoljuk át.
+MAX_PDF_MB = int(os.getenv("MAX_PDF_MB", "50"))
+_MAX_PDF_BYTES = MAX_PDF_MB * 1024 * 1024
+_MAX_B64_LEN = _MAX_PDF_BYTES * 4 // 3 + 64
+
+# A JSON keret (mezőnevek, idézőjelek, data-URI prefix) ráhagyása a body limiten.
+_MAX_JSON_BODY = _MAX_B64_LEN + 64 * 1024
+
+
+def _check_content_length(request: Request, limit: int):
+    """
+    413 még a body beolvasása előtt: a request.body() a teljes kérést
+    bufferelné, így egy óriás body már azelőtt foglalna memóriát, hogy a
+    handler méretellenőrzése egyáltalán lefuthatna.
+    """
+    try:
+        cl = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        cl = 0
+    if cl > limit:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"A payload túl nagy (max {MAX_PDF_MB} MB).",
+        )
+
+def _blob_prefix() -> str:
+    """
+    Egyedi, időben rendezhető blob név prefix.
+
+    A time_ns hex formában monoton növekszik és ~20 ns alatt előáll — a
+    strftime/datetime út mikroszekundumokat vitt kérésenként, miközben a
+    timestampnek itt csak az egyediség + durva sorrend a dolga. A token_hex
+    az azonos nanoszekundumra eső (vagy visszaállított órájú) eseteket fedi le.
+    """
+    return f"{time.time_ns():016x}_{secrets.token_hex(3)}"
+
+
+# Modul szintű singleton (ld. a docint routerben is): a connection string
+# parse + pipeline + TLS felépítése kérésenként tízmilliszekundumos nagyság-
+# rendű volt, a cache-elt kliens connection poolja pedig amortizálja a TCP/TLS-t.
+_bsc: BlobServiceClient | None = None
+
 
 def get_blob_service_client() -> BlobServiceClient:
-    conn_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-    if not conn_str:
-        raise RuntimeError("AZURE_STORAGE_CONNECTION_STRING nincs beállítva.")
-    return BlobServiceClient.from_connection_string(conn_str)
+    # Async kliens: a feltöltés network I/O-ja nem blokkolja az event loopot,
+    # így a worker közben más kéréseket is ki tud szolgálni.
+    global _bsc
+    if _bsc is None:
+        conn_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+        if not conn_str:
+            raise RuntimeError("AZURE_STORAGE_CONNECTION_STRING nincs beállítva.")
+        _bsc = BlobServiceClient.from_connection_string(conn_str)
+    return _bsc
+
+
+async def close_blob_client():
+    """Lifespan shutdown-kor hívjuk, lezárja a cache-elt klienst."""
+    global _bsc
+    if _bsc is not None:
+        await _bsc.close()
+        _bsc = None
 
 
 def slugify_filename(name: str) -> str:
     # levágjuk az esetleges útvonalat
     name = name.split("\\")[-1].split("/")[-1]
 
-    # Unicode normalizálás + ékezetek eldobása
-    name = unicodedata.normalize("NFKD", name)
-    name = name.encode("ascii", "ignore").decode("ascii")
+    # A back-office rendszerekből érkező fájlnevek többsége eleve ASCII —
+    # ilyenkor az egész ékezet-kezelést átugorjuk (az isascii() egyetlen
+    # C szintű bitellenőrzés). Ha nem az, először a gyors translate tábla
+    # fut, és csak a táblán kívüli kódpontokra jön az NFKD normalizálás.
+    if not name.isascii():
+        name = name.translate(_FOLD)
+        if not name.isascii():
+            name = unicodedata.normalize("NFKD", name)
+            name = name.encode("ascii", "ignore").decode("ascii")
 
-    # kényes karakterek -> _
-    name = re.sub(r"[^A-Za-z0-9._-]+", "_", name)
+    # kényes karakterek -> _ (és a több _ egymás után is összeesik).
+    # Idáig érve a név garantáltan ASCII, így bytes-on futtatjuk a regexet;
+    # a végén visszadekódolunk, mert az SDK-nak str blob név kell.
+    raw = _SLUG_RE.sub(b"_", name.encode("ascii")).strip(b"._-")
 
-    # ne legyen nagyon csúnya: több _ egymás után
-    name = re.sub(r"_+", "_", name).strip("._-")
+    return raw.decode("ascii") or "file"
 
-    return name or "file"
+
+async def store_pdf(file_bytes: bytes, file_name: str, content_type: str) -> dict:
+    """
+    Közös tároló lépés: blob név generálás + feltöltés, flow-barát válasszal.
+    """
+    size = len(file_bytes)
+    safe_name = slugify_filename(file_name)
+    blob_name = f"{_blob_prefix()}_{safe_name}"
+
+    try:
+        bsc = get_blob_service_client()
+        container = bsc.get_container_client(CONTAINER_NAME)
+        blob = container.get_blob_client(blob_name)
+
+        # Stream-ként adjuk át: az SDK így blokkokban, párhuzamosan tölti
+        # fel a nagy PDF-eket (max_concurrency), nem egyetlen nagy PUT-tal.
+        await blob.upload_blob(
+            BytesIO(file_bytes),
+            length=size,
+            overwrite=False,
+            max_concurrency=8,
+            content_settings=ContentSettings(content_type=content_type),
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Blob feltöltés hiba: {e}")
+
+    # A buffer már fent van a blobban — a saját referenciánkat elengedjük.
+    # Ez csak akkor szabadít ténylegesen, ha a hívó sem tart már rá
+    # hivatkozást (ld. upload_invoice: del a várakozás előtt).
+    file_bytes = None
+
+    return {
+        "ok": True,
+        "container": CONTAINER_NAME,
+        "blobName": blob_name,
+        "size": size,
+    }
 
 
 @router.post("/invoice")
 async def upload_invoice(request: Request):
 
-    data = await request.json()
+    # Ha a kliens eleve nyers PDF-et küld (Content-Type: application/pdf),
+    # a teljes JSON+base64 utat átugorjuk — a leggyorsabb base64 az,
+    # amelyik nincs. A JSON-os forma marad fallbacknek a régi Flow-khoz.
+    if request.headers.get("content-type", "").startswith("application/pdf"):
+        return await upload_invoice_raw(request)
+
+    _check_content_length(request, _MAX_JSON_BODY)
+
+    # A body-t bytes-ként olvassuk és orjson-nal parse-oljuk — nincs külön
+    # str dekódolás a teljes (akár több MB-os) base64 payloadra.
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Érvénytelen JSON body.")
 
     file_name = data.get("fileName") or "invoice.pdf"
     content_type = data.get("contentType") or "application/pdf"
@@ -51,37 +204,85 @@ async def upload_invoice(request: Request):
             status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
             detail="Csak PDF fájl feltöltése engedélyezett.",
         )
+    if len(content_b64) > _MAX_B64_LEN:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"A payload túl nagy (max {MAX_PDF_MB} MB).",
+        )
 
-    if "," in content_b64:
-        content_b64 = content_b64.split(",", 1)[1]
-
+    # Zero-copy út a dekóderig: a base64 mezőt ASCII bytes-ra váltjuk (ez az
+    # egyetlen elkerülhetetlen másolat), a data-URI prefixet memoryview
+    # slice-szal vágjuk le — nincs még egy több MB-os allokáció —, és a view
+    # megy egyenesen a SIMD dekóderbe.
     try:
-        file_bytes = base64.b64decode(content_b64, validate=True)
-    except Exception:
+        b64 = content_b64.encode("ascii")
+    except UnicodeEncodeError:
         raise HTTPException(
             status_code=400, detail="A 'contentBase64' nem érvényes base64."
         )
 
-    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-    safe_name = slugify_filename(file_name)
-    blob_name = f"{ts}_{safe_name}"
+    # Csak akkor keressük egyáltalán a vesszőt, ha tényleg data: URI jött —
+    # a gyakori (sima base64) esetben ez egyetlen 5 byte-os összehasonlítás.
+    mv = memoryview(b64)
+    if b64[:5] == b"data:":
+        i = b64.find(b",", 5, 256)
+        if i != -1:
+            mv = mv[i + 1 :]
 
+    # validate=True kötelező: e nélkül a pybase64 a stdlib-kompatibilis lassú
+    # ágra esik (az ábécén kívüli byte-okat szó nélkül eldobja — a sérült
+    # upload 200-at kapna), a SIMD gyorsút pedig csak validáló módban fut.
+    # A hibás input így binascii.Error-t (ValueError) dob, azt kapjuk el.
+    #
+    # Szándékosan immutable bytes-ot kérünk (nem bytearray-t): a BytesIO
+    # csak bytes inputtal osztozik a bufferen zero-copy módon, bytearray-ből
+    # teljes másolatot készítene — egy 10 MB-os PDF-nél még egy 10 MB-os
+    # allokáció a feltöltés teljes idejére. Mutálni úgysem mutálja senki.
     try:
-        bsc = get_blob_service_client()
-        container = bsc.get_container_client(CONTAINER_NAME)
-        blob = container.get_blob_client(blob_name)
+        file_bytes = pybase64.b64decode(mv, validate=True)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="A 'contentBase64' nem érvényes base64."
+        )
 
-        blob.upload_blob(
-            file_bytes,
-            overwrite=False,
-            content_settings=ContentSettings(content_type=content_type),
+    # A dekódolt buffer és a base64 forrás lokális referenciáit még a
+    # feltöltés megkezdése előtt eldobjuk — különben a handler frame a
+    # teljes upload alatt fogva tartaná a payload két-három másolatát
+    # (JSON str, base64 bytes, dekódolt bytearray).
+    coro = store_pdf(file_bytes, file_name, content_type)
+    del data, content_b64, b64, mv, file_bytes
+    return await coro
+
+
+@router.post("/invoice/raw")
+async def upload_invoice_raw(request: Request):
+    """
+    Nyers PDF feltöltés: a body maga a PDF (Content-Type: application/pdf),
+    a fájlnév az X-Filename headerben jön (URL-encode-olva).
+
+    Nincs base64 a dróton (se 4/3-os méretnövekedés, se decode a szerveren)
+    — a JSON-os /invoice endpoint marad fallbacknek a régi Flow-khoz.
+    """
+    content_type = request.headers.get("content-type", "")
+    if not content_type.startswith("application/pdf"):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Csak PDF fájl feltöltése engedélyezett.",
         )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Blob feltöltés hiba: {e}")
 
-    return {
-        "ok": True,
-        "container": CONTAINER_NAME,
-        "blobName": blob_name,
-        "size": len(file_bytes),
-    }
+    _check_content_length(request, _MAX_PDF_BYTES)
+
+    file_bytes = await request.body()
+    if not file_bytes:
+        raise HTTPException(status_code=400, detail="Üres request body.")
+    # A Content-Length gate csak a headerre támaszkodik — chunked transfernél
+    # nincs header, ezért a tényleges méretet is ellenőrizzük beolvasás után.
+    if len(file_bytes) > _MAX_PDF_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"A payload túl nagy (max {MAX_PDF_MB} MB).",
+        )
+
+    file_name = unquote(request.headers.get("x-filename", "")) or "invoice.pdf"
+
+    return await store_pdf(file_bytes, file_name, "application/pdf")